@@ -1,10 +1,19 @@
 #!/usr/bin/env lua
 -- Todo MCP Server - Pure Lua implementation with minimal dependencies
 
-local json = require("dkjson") or require("cjson") or (function()
+local function optional_require(name)
+  local ok, mod = pcall(require, name)
+  return ok and mod or nil
+end
+
+-- Prefer lua-cjson (C) for the stdio hot path, then dkjson
+local json = optional_require("cjson") or optional_require("dkjson") or (function()
   -- Minimal JSON implementation if no JSON library available
   local encode, decode
 
+  -- Decoded JSON null, so nulls inside arrays keep their position
+  local null = {}
+
   local escape_char_map = {
     ["\\"] = "\\\\", ["\""] = "\\\"", ["\b"] = "\\b", ["\f"] = "\\f",
     ["\n"] = "\\n", ["\r"] = "\\r", ["\t"] = "\\t"
@@ -22,16 +31,20 @@ local json = require("dkjson") or require("cjson") or (function()
     local t = type(val)
     if t == "string" then return encode_string(val)
     elseif t == "number" or t == "boolean" then return tostring(val)
-    elseif t == "nil" then return "null"
+    elseif t == "nil" or val == null then return "null"
     elseif t == "table" then
-      local is_array = true
+      -- Tables marked the way dkjson marks them are objects even when empty
+      local mt = getmetatable(val)
+      local is_array = not (mt and mt.__jsontype == "object")
       local n = 0
-      for k, _ in pairs(val) do
-        if type(k) ~= "number" or k <= 0 or k % 1 ~= 0 then
-          is_array = false
-          break
+      if is_array then
+        for k, _ in pairs(val) do
+          if type(k) ~= "number" or k <= 0 or k % 1 ~= 0 then
+            is_array = false
+            break
+          end
+          n = math.max(n, k)
         end
-        n = math.max(n, k)
       end
       if is_array and n == #val then
         local parts = {}
@@ -50,10 +63,16 @@ local json = require("dkjson") or require("cjson") or (function()
     error("Cannot encode type: " .. t)
   end
 
+  -- Byte values of JSON's structural characters, so the decoder compares
+  -- numbers instead of slicing out one-character strings
+  local QUOTE, BACKSLASH, COLON, COMMA = 34, 92, 58, 44
+  local LBRACE, RBRACE, LBRACKET, RBRACKET = 123, 125, 91, 93
+
   function decode(str)
     local pos = 1
+    local len = #str
     local function skip_whitespace()
-      pos = str:find("[^ \t\r\n]", pos) or #str + 1
+      pos = str:find("[^ \t\r\n]", pos) or len + 1
     end
 
     local function decode_error(msg)
@@ -62,84 +81,90 @@ local json = require("dkjson") or require("cjson") or (function()
 
     local function decode_value()
       skip_whitespace()
-      local char = str:sub(pos, pos)
-
-      if char == '"' then
-        -- String
-        pos = pos + 1
-        local start = pos
-        while pos <= #str do
-          local c = str:sub(pos, pos)
-          if c == '"' then
-            local result = str:sub(start, pos - 1)
-            pos = pos + 1
-            return result:gsub("\\.", {["\\n"] = "\n", ["\\r"] = "\r", ["\\t"] = "\t", ["\\\""] = '"', ["\\\\"] = "\\"})
-          elseif c == "\\" then
-            pos = pos + 2
+      local byte = str:byte(pos)
+
+      if byte == QUOTE then
+        -- String: jump between quotes and backslashes instead of stepping
+        -- through every character
+        local start = pos + 1
+        local escaped = false
+        pos = start
+        while true do
+          local i = str:find('["\\]', pos)
+          if not i then
+            decode_error("Unterminated string")
+          elseif str:byte(i) == BACKSLASH then
+            escaped = true
+            pos = i + 2
           else
-            pos = pos + 1
+            local result = str:sub(start, i - 1)
+            pos = i + 1
+            if escaped then
+              result = result:gsub("\\.", {["\\n"] = "\n", ["\\r"] = "\r", ["\\t"] = "\t", ["\\\""] = '"', ["\\\\"] = "\\"})
+            end
+            return result
           end
         end
-        decode_error("Unterminated string")
-      elseif char == "{" then
+      elseif byte == LBRACE then
         -- Object
         pos = pos + 1
         local obj = {}
         skip_whitespace()
-        if str:sub(pos, pos) == "}" then
+        if str:byte(pos) == RBRACE then
           pos = pos + 1
           return obj
         end
         while true do
           skip_whitespace()
-          if str:sub(pos, pos) ~= '"' then decode_error("Expected string key") end
+          if str:byte(pos) ~= QUOTE then decode_error("Expected string key") end
           local key = decode_value()
           skip_whitespace()
-          if str:sub(pos, pos) ~= ":" then decode_error("Expected ':'") end
+          if str:byte(pos) ~= COLON then decode_error("Expected ':'") end
           pos = pos + 1
           obj[key] = decode_value()
           skip_whitespace()
-          local c = str:sub(pos, pos)
-          if c == "}" then
+          local c = str:byte(pos)
+          if c == RBRACE then
             pos = pos + 1
             return obj
-          elseif c == "," then
+          elseif c == COMMA then
             pos = pos + 1
           else
             decode_error("Expected ',' or '}'")
           end
         end
-      elseif char == "[" then
+      elseif byte == LBRACKET then
         -- Array
         pos = pos + 1
-        local arr = {}
+        local arr, n = {}, 0
         skip_whitespace()
-        if str:sub(pos, pos) == "]" then
+        if str:byte(pos) == RBRACKET then
           pos = pos + 1
           return arr
         end
         while true do
-          table.insert(arr, decode_value())
+          n = n + 1
+          arr[n] = decode_value()
           skip_whitespace()
-          local c = str:sub(pos, pos)
-          if c == "]" then
+          local c = str:byte(pos)
+          if c == RBRACKET then
             pos = pos + 1
             return arr
-          elseif c == "," then
+          elseif c == COMMA then
             pos = pos + 1
           else
             decode_error("Expected ',' or ']'")
           end
         end
-      elseif str:sub(pos, pos + 3) == "true" then
+      elseif str:find("^true", pos) then
         pos = pos + 4
         return true
-      elseif str:sub(pos, pos + 4) == "false" then
+      elseif str:find("^false", pos) then
         pos = pos + 5
         return false
-      elseif str:sub(pos, pos + 3) == "null" then
+      elseif str:find("^null", pos) then
         pos = pos + 4
-        return nil
+        return null
       else
         -- Number
         local num_str = str:match("^%-?%d+%.?%d*[eE]?[+-]?%d*", pos)
@@ -156,29 +181,28 @@ local json = require("dkjson") or require("cjson") or (function()
     if ok then return result else return nil, result end
   end
 
-  return {encode = encode, decode = decode}
+  return {encode = encode, decode = decode, null = null}
 end)()
 
--- Database operations using sqlite3 command
-local db_path = os.getenv("TODO_MCP_DB") or os.getenv("HOME") .. "/.local/share/nvim/todo-mcp.db"
-
-local function execute_sql(query, get_results)
-  local cmd = string.format("sqlite3 -separator '|' '%s' '%s'", db_path, query)
-  if get_results then
-    local handle = io.popen(cmd)
-    if handle then
-      local result = handle:read("*a")
-      handle:close()
-      return result
-    end
-    return nil
-  else
-    os.execute(cmd)
+-- dkjson decodes null as nil unless told which value to use for it
+local decode_json = json.decode
+if json == package.loaded.dkjson then
+  decode_json = function(str)
+    return json.decode(str, 1, json.null)
   end
 end
 
--- Initialize database
-execute_sql([[
+-- An empty table that encodes as {} rather than []. dkjson and the built-in
+-- encoder read the marker; lua-cjson already encodes empty tables as objects.
+local function empty_object()
+  return setmetatable({}, { __jsontype = "object" })
+end
+
+-- Database operations: one long-lived lsqlite3 connection when available,
+-- otherwise the sqlite3 command
+local db_path = os.getenv("TODO_MCP_DB") or os.getenv("HOME") .. "/.local/share/nvim/todo-mcp.db"
+
+local todos_sql = [[
   CREATE TABLE IF NOT EXISTS todos (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     content TEXT NOT NULL,
@@ -186,210 +210,626 @@ execute_sql([[
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
   );
-]])
-
--- Database functions
-local function get_all_todos()
-  local result = execute_sql("SELECT id, content, done FROM todos ORDER BY done ASC, created_at ASC;", true)
-  local todos = {}
-
-  for line in result:gmatch("[^\n]+") do
-    local id, content, done = line:match("^(%d+)|(.+)|(%d+)$")
-    if id then
-      table.insert(todos, {
-        id = tonumber(id),
-        content = content,
-        done = done == "1"
-      })
+  -- Lets list_todos walk the index in order instead of sorting every call
+  CREATE INDEX IF NOT EXISTS idx_todos_done_created ON todos (done ASC, created_at ASC);
+]]
+
+-- Encode the todo list as a JSON array inside SQLite, so list_todos never
+-- builds per-row Lua tables only to encode them again
+local list_json_sql = [[
+  SELECT json_group_array(json_object(
+    'id', id,
+    'content', content,
+    'done', json(CASE done WHEN 1 THEN 'true' ELSE 'false' END)
+  ))
+  FROM (SELECT id, content, done FROM todos ORDER BY done ASC, created_at ASC)
+]]
+
+local db_ops
+
+local has_lsqlite3, lsqlite3 = pcall(require, "lsqlite3")
+
+if has_lsqlite3 then
+  -- Keep a single connection open for the lifetime of the server so SQLite
+  -- keeps its schema and page cache warm between requests. The stdio loop is
+  -- serial, so no locking is needed.
+  local conn = assert(lsqlite3.open(db_path))
+  -- The Neovim plugin writes to the same file, so wait for its locks rather
+  -- than failing with SQLITE_BUSY
+  conn:exec([[
+    PRAGMA busy_timeout = 5000;
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA wal_autocheckpoint = 1000;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -8000;
+  ]])
+
+  -- Prepared statements keyed by SQL text. Every query below uses constant
+  -- SQL, so each one is compiled once and reused for the life of the server.
+  local statements = {}
+  local in_transaction = false
+
+  local function prepare(sql)
+    local stmt = statements[sql]
+    if not stmt then
+      stmt = assert(conn:prepare(sql), conn:errmsg())
+      statements[sql] = stmt
     end
+    return stmt
   end
 
-  return todos
-end
+  -- Encoded todo list, reused until this connection writes or PRAGMA
+  -- data_version shows another connection (e.g. Neovim) has committed
+  local list_cache, list_version
 
-local function add_todo(content)
-  content = content:gsub("'", "''")
-  execute_sql(string.format("INSERT INTO todos (content) VALUES ('%s');", content))
-  local id_result = execute_sql("SELECT last_insert_rowid();", true)
-  return tonumber(id_result:match("(%d+)"))
-end
+  -- Execute SQL without results, raising SQLite's error message if it fails
+  local function exec(sql)
+    if conn:exec(sql) ~= lsqlite3.OK then
+      error(conn:errmsg(), 0)
+    end
+  end
 
-local function update_todo(id, content, done)
-  local set_clauses = {}
+  -- Step a statement, raising SQLite's error message if it fails
+  local function step(stmt)
+    local rc = stmt:step()
+    if rc ~= lsqlite3.ROW and rc ~= lsqlite3.DONE then
+      local message = conn:errmsg()
+      stmt:reset()
+      error(message, 0)
+    end
+    return rc
+  end
 
-  if content then
-    local escaped = content:gsub("'", "''")
-    table.insert(set_clauses, string.format("content = '%s'", escaped))
+  -- Run a statement with bound parameters, returning the number of changed rows
+  local function run(sql, ...)
+    list_cache = nil
+    local stmt = prepare(sql)
+    stmt:bind_values(...)
+    step(stmt)
+    stmt:reset()
+    return conn:changes()
   end
 
-  if done ~= nil then
-    table.insert(set_clauses, string.format("done = %d", done and 1 or 0))
+  -- Run a statement and return the first column of its first row
+  local function value(sql, ...)
+    local stmt = prepare(sql)
+    stmt:bind_values(...)
+    local result = step(stmt) == lsqlite3.ROW and stmt:get_value(0) or nil
+    stmt:reset()
+    return result
   end
 
-  if #set_clauses > 0 then
-    table.insert(set_clauses, "updated_at = CURRENT_TIMESTAMP")
-    local query = string.format("UPDATE todos SET %s WHERE id = %d;", table.concat(set_clauses, ", "), id)
-    execute_sql(query)
-    return true
+  db_ops = {
+    init = function()
+      conn:exec(todos_sql)
+    end,
+
+    get_all_json = function()
+      local version = value("PRAGMA data_version")
+      if list_cache and version == list_version then
+        return list_cache
+      end
+
+      local todos = value(list_json_sql) or "[]"
+      list_cache, list_version = todos, version
+      return todos
+    end,
+
+    add = function(content)
+      list_cache = nil
+      return value("INSERT INTO todos (content) VALUES (?) RETURNING id", content)
+    end,
+
+    add_many = function(contents)
+      local ids = {}
+      db_ops.transaction(function()
+        for i, content in ipairs(contents) do
+          ids[i] = db_ops.add(content)
+        end
+      end)
+      return ids
+    end,
+
+    update = function(id, content, done)
+      if content == nil and done == nil then
+        return false
+      end
+
+      -- NULL leaves the column unchanged
+      if done ~= nil then
+        done = done and 1 or 0
+      end
+
+      return run(
+        "UPDATE todos SET content = COALESCE(?, content), done = COALESCE(?, done), updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+        content, done, id
+      ) > 0
+    end,
+
+    delete = function(id)
+      return run("DELETE FROM todos WHERE id = ?", id) > 0
+    end,
+
+    -- Run fn(...) inside one transaction so a batch of writes commits once.
+    -- Nested calls use a savepoint, so a failing request inside a batch only
+    -- undoes its own writes.
+    transaction = function(fn, ...)
+      local outer = not in_transaction
+      -- IMMEDIATE takes the write lock up front. A deferred transaction that
+      -- reads first cannot wait out another writer when it later upgrades, so
+      -- it fails with "database is locked" regardless of busy_timeout.
+      local begin, commit, rollback = "BEGIN IMMEDIATE", "COMMIT", "ROLLBACK"
+      if not outer then
+        begin, commit, rollback = "SAVEPOINT request", "RELEASE request", "ROLLBACK TO request; RELEASE request"
+      end
+
+      exec(begin)
+      in_transaction = true
+      local ok, result = pcall(fn, ...)
+      local done, err = ok, result
+      if done then
+        -- A failed COMMIT leaves the transaction open, so roll it back below
+        done, err = pcall(exec, commit)
+      end
+      if not done then
+        conn:exec(rollback)
+        -- data_version does not change for our own rollback, so a list read
+        -- inside the transaction would otherwise outlive its rows
+        list_cache = nil
+      end
+      if outer then
+        in_transaction = false
+      end
+
+      if not done then
+        error(err, 0)
+      end
+      return result
+    end,
+
+    close = function()
+      -- Cached statements live as long as the connection, so finalize them
+      -- explicitly before closing it
+      for sql, stmt in pairs(statements) do
+        stmt:finalize()
+        statements[sql] = nil
+      end
+      conn:close()
+    end
+  }
+else
+  local function shell_quote(str)
+    return "'" .. str:gsub("'", "'\\''") .. "'"
   end
 
-  return false
-end
+  local function execute_sql(query, get_results)
+    local cmd = string.format("sqlite3 -separator '|' %s %s", shell_quote(db_path), shell_quote(query))
+    if get_results then
+      local handle = io.popen(cmd)
+      if handle then
+        local result = handle:read("*a")
+        handle:close()
+        return result
+      end
+      return nil
+    else
+      os.execute(cmd)
+    end
+  end
+
+  -- Whether the output of a trailing "SELECT changes();" reports a row
+  local function changed(result)
+    return (tonumber(result and result:match("%d+")) or 0) > 0
+  end
 
-local function delete_todo(id)
-  execute_sql(string.format("DELETE FROM todos WHERE id = %d;", id))
-  return true
+  db_ops = {
+    init = function()
+      -- WAL mode is stored in the database file, so it also applies to each
+      -- sqlite3 invocation below. Read the result so the pragma's output
+      -- does not end up on the MCP stream.
+      execute_sql("PRAGMA journal_mode = WAL;", true)
+      execute_sql(todos_sql)
+    end,
+
+    get_all_json = function()
+      local result = (execute_sql(list_json_sql .. ";", true) or ""):match("^%s*(.-)%s*$")
+      -- A failed or silent sqlite3 run must still produce a valid list
+      if result == "" then
+        return "[]"
+      end
+      return result
+    end,
+
+    add = function(content)
+      return db_ops.add_many({ content })[1]
+    end,
+
+    add_many = function(contents)
+      -- One sqlite3 invocation and one transaction for the whole list, with
+      -- RETURNING printing each new id on its own line
+      local inserts = {}
+      for i, content in ipairs(contents) do
+        inserts[i] = string.format("INSERT INTO todos (content) VALUES ('%s') RETURNING id;", (content:gsub("'", "''")))
+      end
+      local result = execute_sql("BEGIN; " .. table.concat(inserts, " ") .. " COMMIT;", true) or ""
+      local ids = {}
+      for id in result:gmatch("%d+") do
+        table.insert(ids, tonumber(id))
+      end
+      return ids
+    end,
+
+    update = function(id, content, done)
+      if content == nil and done == nil then
+        return false
+      end
+
+      local content_sql = content and ("'" .. content:gsub("'", "''") .. "'") or "NULL"
+      local done_sql = done == nil and "NULL" or (done and "1" or "0")
+      return changed(execute_sql(string.format(
+        "UPDATE todos SET content = COALESCE(%s, content), done = COALESCE(%s, done), updated_at = CURRENT_TIMESTAMP WHERE id = %d; SELECT changes();",
+        content_sql, done_sql, id
+      ), true))
+    end,
+
+    delete = function(id)
+      return changed(execute_sql(string.format("DELETE FROM todos WHERE id = %d; SELECT changes();", id), true))
+    end,
+
+    -- Every sqlite3 invocation commits on its own
+    transaction = function(fn, ...)
+      return fn(...)
+    end,
+
+    close = function() end
+  }
 end
 
--- MCP protocol implementation
-local function handle_request(request)
-  local method = request.method
-
-  if method == "initialize" then
-    return {
-      protocolVersion = "2024-11-05",
-      capabilities = {
-        tools = {}
-      },
-      serverInfo = {
-        name = "todo-mcp",
-        version = "1.0.0"
-      }
+-- Initialize database
+db_ops.init()
+
+-- Input schema for each tool
+local list_todos_schema = {
+  type = "object",
+  properties = empty_object()
+}
+
+local add_todo_schema = {
+  type = "object",
+  properties = {
+    content = {
+      type = "string",
+      description = "The todo item content"
     }
-
-  elseif method == "tools/list" then
-    return {
-      tools = {
-        {
-          name = "list_todos",
-          description = "List all todo items",
-          inputSchema = {
-            type = "object",
-            properties = {}
-          }
-        },
-        {
-          name = "add_todo",
-          description = "Add a new todo item",
-          inputSchema = {
-            type = "object",
-            properties = {
-              content = {
-                type = "string",
-                description = "The todo item content"
-              }
-            },
-            required = {"content"}
-          }
-        },
-        {
-          name = "update_todo",
-          description = "Update a todo item",
-          inputSchema = {
-            type = "object",
-            properties = {
-              id = {
-                type = "number",
-                description = "The todo item ID"
-              },
-              content = {
-                type = "string",
-                description = "New content (optional)"
-              },
-              done = {
-                type = "boolean",
-                description = "Mark as done/undone (optional)"
-              }
-            },
-            required = {"id"}
-          }
-        },
-        {
-          name = "delete_todo",
-          description = "Delete a todo item",
-          inputSchema = {
-            type = "object",
-            properties = {
-              id = {
-                type = "number",
-                description = "The todo item ID to delete"
-              }
-            },
-            required = {"id"}
-          }
-        }
-      }
+  },
+  required = {"content"}
+}
+
+local add_todos_schema = {
+  type = "object",
+  properties = {
+    contents = {
+      type = "array",
+      items = { type = "string" },
+      description = "The todo item contents"
     }
+  },
+  required = {"contents"}
+}
+
+local update_todo_schema = {
+  type = "object",
+  properties = {
+    id = {
+      type = "number",
+      description = "The todo item ID"
+    },
+    content = {
+      type = "string",
+      description = "New content (optional)"
+    },
+    done = {
+      type = "boolean",
+      description = "Mark as done/undone (optional)"
+    }
+  },
+  required = {"id"}
+}
+
+local delete_todo_schema = {
+  type = "object",
+  properties = {
+    id = {
+      type = "number",
+      description = "The todo item ID to delete"
+    }
+  },
+  required = {"id"}
+}
+
+-- The tool list never changes, so encode the tools/list result once
+local tools_list = json.encode({
+  tools = {
+    { name = "list_todos", description = "List all todo items", inputSchema = list_todos_schema },
+    { name = "add_todo", description = "Add a new todo item", inputSchema = add_todo_schema },
+    { name = "add_todos", description = "Add several todo items at once", inputSchema = add_todos_schema },
+    { name = "update_todo", description = "Update a todo item", inputSchema = update_todo_schema },
+    { name = "delete_todo", description = "Delete a todo item", inputSchema = delete_todo_schema }
+  }
+})
 
-  elseif method == "tools/call" then
-    local params = request.params or {}
-    local tool_name = params.name
-    local args = params.arguments or {}
+-- Shared default for missing params/arguments; never mutated
+local EMPTY = {}
 
-    if tool_name == "list_todos" then
-      return { todos = get_all_todos() }
+-- Reject a call's params. respond turns the raised table into a -32602
+-- error response rather than an internal error.
+local function invalid_params(message)
+  error({ code = -32602, message = message }, 0)
+end
 
-    elseif tool_name == "add_todo" then
-      if args.content then
-        local id = add_todo(args.content)
-        return { id = id, success = true }
-      else
-        return { error = "Missing content parameter" }
-      end
+-- Tool implementations, dispatched by tool name with the call arguments
+local tools = {
+  list_todos = function(args)
+    return '{"todos":' .. db_ops.get_all_json() .. '}'
+  end,
+
+  add_todo = function(args)
+    if args.content == nil then
+      invalid_params("Missing content parameter")
+    elseif type(args.content) ~= "string" then
+      invalid_params("content must be a string")
+    end
 
-    elseif tool_name == "update_todo" then
-      if args.id then
-        local success = update_todo(args.id, args.content, args.done)
-        return { success = success }
-      else
-        return { error = "Missing id parameter" }
-      end
+    local id = db_ops.add(args.content)
+    return { id = id, success = true }
+  end,
 
-    elseif tool_name == "delete_todo" then
-      if args.id then
-        local success = delete_todo(args.id)
-        return { success = success }
-      else
-        return { error = "Missing id parameter" }
+  add_todos = function(args)
+    local contents = args.contents
+    if type(contents) ~= "table" or #contents == 0 then
+      invalid_params("Missing contents parameter")
+    end
+
+    for _, content in ipairs(contents) do
+      if type(content) ~= "string" then
+        invalid_params("contents must be an array of strings")
       end
+    end
+
+    local ids = db_ops.add_many(contents)
+    return { ids = ids, success = true }
+  end,
 
+  update_todo = function(args)
+    if args.content ~= nil and type(args.content) ~= "string" then
+      invalid_params("content must be a string")
+    elseif args.id then
+      local success = db_ops.update(args.id, args.content, args.done)
+      return { success = success }
     else
-      return { error = "Unknown tool: " .. tostring(tool_name) }
+      invalid_params("Missing id parameter")
     end
+  end,
 
+  delete_todo = function(args)
+    if args.id then
+      local success = db_ops.delete(args.id)
+      return { success = success }
+    else
+      invalid_params("Missing id parameter")
+    end
+  end
+}
+
+-- The initialize result is static too
+local server_info = json.encode({
+  protocolVersion = "2024-11-05",
+  capabilities = {
+    tools = empty_object()
+  },
+  serverInfo = {
+    name = "todo-mcp",
+    version = "1.0.0"
+  }
+})
+
+-- MCP protocol implementation, dispatched by method name
+local handlers = {
+  initialize = function(request)
+    return server_info
+  end,
+
+  ["tools/list"] = function(request)
+    return tools_list
+  end,
+
+  ["tools/call"] = function(request)
+    local params = request.params or EMPTY
+    local tool = tools[params.name]
+    if tool then
+      return tool(params.arguments or EMPTY)
+    else
+      invalid_params("Unknown tool: " .. tostring(params.name))
+    end
+  end
+}
+
+-- stdout is fully buffered and flushed once per message, so each response
+-- reaches the client in a single write
+local stdin, stdout = io.stdin, io.stdout
+stdout:setvbuf("full")
+
+-- Read the next message. MCP's stdio transport is newline-delimited JSON,
+-- but a message that starts with a Content-Length header is read as exactly
+-- that many bytes instead of being scanned for a newline. Returns the
+-- payload and whether it was length-framed.
+local function receive()
+  local line = stdin:read("*l")
+  if not line then return nil end
+
+  local length = line:match("^Content%-Length:%s*(%d+)")
+  if not length then
+    return line, false
+  end
+
+  -- Skip any remaining headers up to the blank separator line
+  repeat
+    local header = stdin:read("*l")
+  until not header or header == "" or header == "\r"
+
+  return stdin:read(tonumber(length)), true
+end
+
+-- Write one message, using the same framing the request arrived with
+local function send(encoded, framed)
+  if framed then
+    stdout:write("Content-Length: ", #encoded, "\r\n\r\n", encoded)
   else
-    return { error = "Unknown method: " .. tostring(method) }
+    stdout:write(encoded, "\n")
+  end
+  stdout:flush()
+end
+
+local parse_error = json.encode({
+  jsonrpc = "2.0",
+  error = {
+    code = -32700,
+    message = "Parse error"
+  }
+})
+
+-- Encode a JSON-RPC error response, echoing the request id when there is one
+local function error_response(request, code, message, data)
+  return json.encode({
+    jsonrpc = "2.0",
+    id = type(request) == "table" and request.id or nil,
+    error = {
+      code = code,
+      message = message,
+      data = data
+    }
+  })
+end
+
+-- Every decoder returns json.null for null. Drop it from objects so handlers
+-- see nil for a null field, but keep it in arrays, where removing it would
+-- shift or hide the entries after it.
+local function strip_nulls(value)
+  if type(value) == "table" then
+    for key, item in pairs(value) do
+      if item == json.null and type(key) ~= "number" then
+        value[key] = nil
+      elseif item ~= json.null then
+        strip_nulls(item)
+      end
+    end
   end
+  return value
+end
+
+-- Run a handler and encode its result, so a failing handler turns into an
+-- error response instead of stopping the server
+local function encode_result(handler, request)
+  local result = handler(request)
+  if type(result) == "table" then
+    result = json.encode(result)
+  end
+  return result
+end
+
+-- Handle one decoded request and return the encoded response. Results are
+-- encoded on their own, or arrive pre-encoded, and the JSON-RPC envelope is
+-- written around them as text rather than added to a table and re-encoded.
+-- Notifications (requests without an id) are handled but get no response.
+local function respond(request, in_batch)
+  if type(request) ~= "table" or type(request.method) ~= "string" then
+    return error_response(request, -32600, "Invalid Request")
+  end
+
+  local handler = handlers[request.method]
+  if not handler and request.id == nil then
+    return nil
+  elseif not handler then
+    return error_response(request, -32601, "Unknown method: " .. request.method)
+  end
+
+  -- Inside a batch each request gets its own savepoint, so a failure only
+  -- undoes its own writes. Standalone requests need no transaction.
+  local ok, result
+  if in_batch then
+    ok, result = pcall(db_ops.transaction, encode_result, handler, request)
+  else
+    ok, result = pcall(encode_result, handler, request)
+  end
+  if request.id == nil then
+    return nil
+  elseif not ok and type(result) == "table" then
+    return error_response(request, result.code, result.message)
+  elseif not ok then
+    return error_response(request, -32603, "Internal error", tostring(result))
+  end
+
+  return '{"jsonrpc":"2.0","id":' .. json.encode(request.id) .. ',"result":' .. result .. "}"
+end
+
+-- Answer a JSON-RPC batch with one array, committing its writes together.
+-- Returns nil when every entry was a notification.
+local function respond_batch(batch)
+  local count = #batch
+  if count == 0 then
+    return error_response(nil, -32600, "Invalid Request")
+  end
+
+  local responses = {}
+  local ok, err = pcall(db_ops.transaction, function()
+    for i = 1, count do
+      local item_ok, response = pcall(respond, batch[i], true)
+      if not item_ok then
+        response = error_response(batch[i], -32603, "Internal error", tostring(response))
+      end
+      responses[#responses + 1] = response
+    end
+  end)
+
+  if not ok then
+    -- The batch's writes were rolled back, so none of its results stand
+    responses = {}
+    for i = 1, count do
+      local item = batch[i]
+      if type(item) ~= "table" or item.id ~= nil then
+        responses[#responses + 1] = error_response(item, -32603, "Internal error", tostring(err))
+      end
+    end
+  end
+
+  if #responses == 0 then
+    return nil
+  end
+  return "[" .. table.concat(responses, ",") .. "]"
 end
 
 -- Main server loop
 while true do
-  local line = io.read("*l")
-  if not line then break end
+  local message, framed = receive()
+  if not message then break end
 
-  local ok, request = pcall(json.decode, line)
-  if ok and request then
-    local response = handle_request(request)
+  local ok, request = pcall(decode_json, message)
+  if ok then
+    request = strip_nulls(request)
+  end
 
-    -- Add JSON-RPC fields
-    response.jsonrpc = "2.0"
-    if request.id then
-      response.id = request.id
-    end
+  local response = parse_error
+  if ok and type(request) == "table" and message:find("^%s*%[") then
+    response = respond_batch(request)
+  elseif ok and request then
+    response = respond(request)
+  end
 
-    -- Send response
-    io.write(json.encode(response) .. "\n")
-    io.flush()
-  else
-    -- Send error response
-    local error_response = {
-      jsonrpc = "2.0",
-      error = {
-        code = -32700,
-        message = "Parse error"
-      }
-    }
-    io.write(json.encode(error_response) .. "\n")
-    io.flush()
+  if response then
+    send(response, framed)
   end
-end
\ No newline at end of file
+end
+
+db_ops.close()
@@ -0,0 +1,87 @@
+-- Runs mcp-server.lua as a real process and drives it over stdio
+describe("MCP server process", function()
+  local lua = arg and arg[-1] or "lua"
+
+  local function has_sqlite()
+    if pcall(require, "lsqlite3") then
+      return true
+    end
+    local ok = os.execute("command -v sqlite3 >/dev/null 2>&1")
+    return ok == true or ok == 0
+  end
+
+  local function request(id, method, params)
+    return string.format('{"jsonrpc":"2.0","id":%d,"method":"%s","params":%s}', id, method, params or "{}")
+  end
+
+  local function framed(payload)
+    return "Content-Length: " .. #payload .. "\r\n\r\n" .. payload
+  end
+
+  local function contains(text, fragment)
+    return text:find(fragment, 1, true) ~= nil
+  end
+
+  -- Feed the server one stdin stream and return everything it wrote
+  local function run_server(input)
+    local db_path = os.tmpname()
+    local in_path = os.tmpname()
+    local out_path = os.tmpname()
+    os.remove(db_path)
+
+    local file = io.open(in_path, "w")
+    file:write(input)
+    file:close()
+
+    os.execute(string.format("TODO_MCP_DB='%s' %s mcp-server.lua < '%s' > '%s'", db_path, lua, in_path, out_path))
+
+    file = io.open(out_path, "r")
+    local output = file:read("*a")
+    file:close()
+
+    for _, path in ipairs({ db_path, db_path .. "-wal", db_path .. "-shm", in_path, out_path }) do
+      os.remove(path)
+    end
+    return output
+  end
+
+  it("should keep serving across batch, framed, add_todos and malformed messages", function()
+    if not has_sqlite() then
+      print("    (skipped: neither lsqlite3 nor the sqlite3 command is available)")
+      return
+    end
+
+    local output = run_server(table.concat({
+      "[" .. request(1, "initialize") .. "," .. request(2, "tools/list") .. "]\n",
+      "{not json\n",
+      request(3, "tools/call", '{"name":"add_todos","arguments":{"contents":["one","two"]}}') .. "\n",
+      framed(request(4, "tools/call", '{"name":"list_todos"}')),
+      request(5, "tools/call", '{"name":"list_todos"}') .. "\n",
+    }))
+
+    local lines = {}
+    for line in output:gmatch("[^\n]+") do
+      lines[#lines + 1] = line
+    end
+
+    -- The batch is answered with one array holding both responses
+    assert.is_true(contains(lines[1], '[{"jsonrpc":"2.0"'))
+    assert.is_true(contains(lines[1], '"id":1'))
+    assert.is_true(contains(lines[1], '"id":2'))
+
+    -- Malformed JSON gets a parse error rather than stopping the server
+    assert.is_true(contains(lines[2], '"code":-32700'))
+
+    assert.is_true(contains(lines[3], '"id":3'))
+    assert.is_true(contains(lines[3], '"ids":[1,2]'))
+
+    -- The framed request is answered with the same framing
+    assert.is_true(contains(output, "Content-Length: "))
+    assert.is_true(contains(output, '"id":4'))
+
+    -- The last request is still answered, so the process stayed alive
+    local last = lines[#lines]
+    assert.is_true(contains(last, '"id":5'))
+    assert.is_true(contains(last, '"content":"two"'))
+  end)
+end)